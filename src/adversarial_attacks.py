@@ -1,5 +1,5 @@
 import numpy as np
-from perturb_proj_tree import PerturbProjTree
+from perturb_proj_tree import cached_perturb_proj_tree
 from alpha_shape import alpha_shape_border
 from sampling import farthest_point_sampling, radial_basis_sampling, sample_on_line_segments
 
@@ -9,7 +9,7 @@ def iter_l2_attack_n_proj(model, x, y, params):
     tau = float(params["tau"])
 
     epsilon = epsilon / float(n)
-    tree = PerturbProjTree(x, thickness = tau)
+    tree = cached_perturb_proj_tree(x, thickness = tau)
     x_perturb = x
 
     for i in range(n):
@@ -27,7 +27,7 @@ def mom_l2_attack_n_proj(model, x, y, params):
     tau = params["tau"]
 
     epsilon = epsilon / float(n)
-    tree = PerturbProjTree(x, thickness = tau)
+    tree = cached_perturb_proj_tree(x, thickness = tau)
     x_perturb = x
     grad = np.zeros(x.shape)
 
@@ -63,7 +63,7 @@ def iter_l2_attack_1_proj(model, x, y, params):
     tau = params["tau"]
 
     epsilon = epsilon / float(n)
-    tree = PerturbProjTree(x, thickness = tau)
+    tree = cached_perturb_proj_tree(x, thickness = tau)
     x_perturb = x
 
     for i in range(n):
@@ -93,7 +93,7 @@ def normal_jitter(model, x, y, params):
     epsilon = float(params["epsilon"])
     tau = float(params["tau"])
 
-    tree = PerturbProjTree(x, thickness = tau)
+    tree = cached_perturb_proj_tree(x, thickness = tau)
     perturb = np.random.normal(size = x.shape)
     perturb = epsilon * perturb / np.sqrt(np.sum(perturb ** 2))
     x_perturb = x + perturb
@@ -315,7 +315,7 @@ def iter_l2_adversarial_sticks(model, x, y, params):
     sigma = int(params["sigma"])
 
     epsilon = epsilon / float(n)
-    tree = PerturbProjTree(x)
+    tree = cached_perturb_proj_tree(x)
     x_perturb = x
 
     for i in range(n):
@@ -362,7 +362,7 @@ def iter_l2_attack_sinks(model, x, y, params):
     num_sinks = int(params["num_sinks"])
 
     dists = np.linalg.norm(x[:, np.newaxis, :] - x[np.newaxis, :, :], axis = 2)
-    dists = np.where(np.eye(len(x)) > 0.0, np.full(dists.shape, np.inf), dists)
+    np.fill_diagonal(dists, np.inf)
     avg_min_dist = np.mean(np.min(dists, axis = 1))
     mu = mu * avg_min_dist
 
@@ -1,18 +1,28 @@
 import numpy as np
+from scipy.spatial.distance import cdist
 
 def remove_outliers_defense(model, x, params):
     top_k = int(params["top_k"])
     num_std = float(params["num_std"])
 
-    dists = x[np.newaxis, :, :] - x[:, np.newaxis, :]
-    dists = np.linalg.norm(dists, axis = 2)
-
-    dists = np.where(np.eye(len(x)) > 0.0, np.full(dists.shape, np.inf), dists)
-    dists = np.sort(dists, axis = 1)[:, :top_k]
+    # squared pairwise distances from a compiled kernel, without any (N, N, 3) temporary, and
+    # without the cancellation error of expanding ||a - b||^2 into ||a||^2 + ||b||^2 - 2 * a . b
+    dists = cdist(x, x, "sqeuclidean")
+    np.fill_diagonal(dists, np.inf)
+
+    # only the top_k nearest distances are needed, and they do not need to be sorted
+    # since they are averaged right after, so a linear time partition is enough
+    # partition in place, so no other N x N array is allocated
+    dists.partition(top_k - 1, axis = 1)
+    dists = dists[:, :top_k]
+    dists = np.sqrt(dists)
     dists = np.mean(dists, axis = 1)
 
-    avg = np.mean(dists)
-    std = num_std * np.std(dists)
+    # mean and standard deviation from the sum of the distances and the sum of their squares,
+    # instead of np.std subtracting the mean in a separate pass over a temporary array
+    avg = np.sum(dists) / len(dists)
+    var = np.dot(dists, dists) / len(dists) - avg * avg
+    std = num_std * np.sqrt(max(var, 0.0))
 
     remove = dists > avg + std
     idx = np.argmin(remove)
@@ -24,9 +34,12 @@ def remove_salient_defense(model, x, params):
     top_k = int(params["top_k"])
 
     grads = model.output_grad_fn(x)
-    norms = np.linalg.norm(grads, axis = 2)
+    # saliency of each point is the largest gradient norm over all outputs
+    # squared norms rank the points the same way, so no square root is needed
+    norms = np.einsum("ijk,ijk->ij", grads, grads)
     norms = np.max(norms, axis = 0)
-    remove = np.argsort(norms)[-top_k:]
+    # the top_k most salient points, in no particular order
+    remove = np.argpartition(norms, -top_k)[-top_k:]
 
     mask = np.zeros(len(x))
     mask[remove] = 1.0
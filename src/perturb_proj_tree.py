@@ -1,141 +1,247 @@
 import numpy as np
-from numba import jit
-from projection import project_point_to_triangle, bounding_sphere, corner_point
+import math
+from collections import OrderedDict
+from numba import jit, prange
+from projection import project_point_to_triangle_pre, all_triangle_normals, bounding_spheres
 from alpha_shape import alpha_shape_border
 
-@jit(nopython = True)
-def _query(query_point, query_radius, curr_node, thickness, center, radius_lo, radius_hi, inside_node, outside_node, triangle, is_leaf):
-    # project a point onto its nearest triangles and find the nearest projection location
-    nearest = (None, np.inf)
-
-    if is_leaf[curr_node]:
-        if np.linalg.norm(query_point - center[curr_node]) <= query_radius:
-            # project the point at the leaf node
-            proj_point = project_point_to_triangle(query_point, triangle[curr_node], thickness = thickness)
-            proj_dist = np.linalg.norm(query_point - proj_point)
-            nearest = (proj_point, proj_dist)
-    else:
-        dist = np.linalg.norm(query_point - center[curr_node])
-
-        if dist > radius_lo[curr_node] + query_radius: # query and partition spheres are completely not overlapping
-            nearest = _query(query_point, query_radius, outside_node[curr_node], thickness, center, radius_lo, radius_hi, inside_node, outside_node, triangle, is_leaf)
-        elif dist < radius_hi[curr_node] - query_radius: # query and partition spheres are completely overlapping
-            nearest = _query(query_point, query_radius, inside_node[curr_node], thickness, center, radius_lo, radius_hi, inside_node, outside_node, triangle, is_leaf)
-        else:
-            # must examine both subtrees as the border of the query sphere overlaps the border of the partition sphere
-            nearest_inside = _query(query_point, query_radius, inside_node[curr_node], thickness, center, radius_lo, radius_hi, inside_node, outside_node, triangle, is_leaf)
-            nearest_outside = _query(query_point, query_radius, outside_node[curr_node], thickness, center, radius_lo, radius_hi, inside_node, outside_node, triangle, is_leaf)
-
-            if nearest_inside[1] < nearest_outside[1]:
-                nearest = nearest_inside
-            else:
-                nearest = nearest_outside
-
-    return nearest
-
-@jit(nopython = True)
-def _project(x_perturb, perturb, max_radius, thickness, root, center, radius_lo, radius_hi, inside_node, outside_node, triangle, is_leaf):
-    epsilon = 1e-8
-    distances = np.sqrt(np.sum(perturb ** 2, axis = 1))
-    x_proj = []
+# fast math flags for the tree kernels, except for the ones that assume there are no infinities or NaNs, since
+# the nearest distance starts as infinity and degenerate triangles have NaN normals
+_fastmath = {"nsz", "arcp", "contract", "afn", "reassoc"}
 
-    for i in range(len(x_perturb)):
-        if np.abs(distances[i]) < epsilon: # points that are not perturbed are also not projected
-            x_proj.append(x_perturb[i])
+@jit(nopython = True, fastmath = _fastmath, cache = True)
+def _query(query_point, query_radius, root, thickness, max_radius, split_axis, split_lo, split_hi, lower_node, upper_node, tri_center, tri_radius, triangle, tri_normal, tri_border_normal):
+    # project a point onto its nearest triangles and find the nearest projection location
+    # distances are compared squared, so square roots are only taken for the leaf lower bounds
+    # the nearest projection is kept as scalars, so it stays in registers during the traversal
+    nearest_x = query_point[0]
+    nearest_y = query_point[1]
+    nearest_z = query_point[2]
+    nearest_dist_sq = np.inf
+    query_radius_sq = query_radius * query_radius
+
+    # nodes that still need to be visited are kept in an explicit stack instead of recursing
+    # the tree is split at the median, so its depth (and the stack size) is logarithmic
+    # each node is stored with a lower bound of the distance from the query point to its triangle points
+    stack = np.empty(64, dtype = np.int64)
+    stack_bound = np.empty(64)
+    stack[0] = root
+    stack_bound[0] = 0.0
+    stack_size = 1
+
+    while stack_size > 0:
+        stack_size -= 1
+        curr_node = stack[stack_size]
+
+        # skip subtrees that cannot have a projection nearer than the nearest projection found so far
+        lower_bound = stack_bound[stack_size] - max_radius - thickness
+
+        if lower_bound > 0.0 and lower_bound * lower_bound > nearest_dist_sq:
+            continue
+
+        if lower_node[curr_node] < 0:
+            # the triangles of a leaf are stored next to each other, so all of them are projected in one pass
+            leaf_start = -1 - lower_node[curr_node]
+
+            for tri_idx in range(leaf_start, leaf_start + upper_node[curr_node]):
+                # distance test with scalars, so no temporary array is allocated per triangle
+                dx = query_point[0] - tri_center[tri_idx, 0]
+                dy = query_point[1] - tri_center[tri_idx, 1]
+                dz = query_point[2] - tri_center[tri_idx, 2]
+                center_dist_sq = dx * dx + dy * dy + dz * dz
+
+                if center_dist_sq <= query_radius_sq:
+                    # a projection onto the triangle cannot be closer than its bounding sphere minus the thickness,
+                    # so skip triangles that cannot beat the nearest projection found so far
+                    lower_bound = math.sqrt(center_dist_sq) - tri_radius[tri_idx] - thickness
+
+                    if lower_bound <= 0.0 or lower_bound * lower_bound <= nearest_dist_sq:
+                        # project the point onto the triangle, in the same precision as the query point
+                        proj_x, proj_y, proj_z = project_point_to_triangle_pre(query_point, triangle[tri_idx], tri_normal[tri_idx], tri_border_normal[tri_idx], thickness = thickness)
+                        px = query_point[0] - proj_x
+                        py = query_point[1] - proj_y
+                        pz = query_point[2] - proj_z
+                        proj_dist_sq = px * px + py * py + pz * pz
+
+                        if proj_dist_sq < nearest_dist_sq:
+                            nearest_x = proj_x
+                            nearest_y = proj_y
+                            nearest_z = proj_z
+                            nearest_dist_sq = proj_dist_sq
         else:
-            # query radius = the perturbation distance
-            # + maximum radius of all triangle circumcircles
-            # + thickness of each triangle
-            nearest_point, nearest_dist = _query(x_perturb[i], distances[i] + max_radius + thickness, root, thickness, center, radius_lo, radius_hi, inside_node, outside_node, triangle, is_leaf)
-
-            if nearest_point is None:
-                x_proj.append(x_perturb[i] - perturb[i])
+            coord = query_point[split_axis[curr_node]]
+            # distances from the query point to the halves along the split axis
+            lower_bound_lo = max(stack_bound[stack_size], coord - split_lo[curr_node])
+            lower_bound_hi = max(stack_bound[stack_size], split_hi[curr_node] - coord)
+
+            if coord - query_radius > split_lo[curr_node]: # query sphere is completely above the lower half
+                stack[stack_size] = upper_node[curr_node]
+                stack_bound[stack_size] = lower_bound_hi
+                stack_size += 1
+            elif coord + query_radius < split_hi[curr_node]: # query sphere is completely below the upper half
+                stack[stack_size] = lower_node[curr_node]
+                stack_bound[stack_size] = lower_bound_lo
+                stack_size += 1
+            elif lower_bound_lo <= lower_bound_hi:
+                # must examine both subtrees as the query sphere crosses the splitting planes
+                # the closer subtree is pushed last so it is visited first, which lets the
+                # nearest projection found there prune the farther subtree
+                stack[stack_size] = upper_node[curr_node]
+                stack_bound[stack_size] = lower_bound_hi
+                stack[stack_size + 1] = lower_node[curr_node]
+                stack_bound[stack_size + 1] = lower_bound_lo
+                stack_size += 2
             else:
-                x_proj.append(nearest_point)
+                stack[stack_size] = lower_node[curr_node]
+                stack_bound[stack_size] = lower_bound_lo
+                stack[stack_size + 1] = upper_node[curr_node]
+                stack_bound[stack_size + 1] = lower_bound_hi
+                stack_size += 2
 
-    return x_proj
+    return nearest_x, nearest_y, nearest_z, nearest_dist_sq
 
-@jit(nopython = True)
-def _calc_tri_center(border_points, border_tri):
-    triangles = []
-    tri_center = []
-    max_radius = 0.0
+@jit(nopython = True, parallel = True, fastmath = _fastmath, cache = True)
+def _project(query_points, query_radius, thickness, max_radius, root, split_axis, split_lo, split_hi, lower_node, upper_node, tri_center, tri_radius, triangle, tri_normal, tri_border_normal):
+    x_proj = np.empty(query_points.shape)
+    found = np.empty(len(query_points), dtype = np.bool_)
 
-    for i in range(len(border_tri)):
-        # get the minimum bounding sphere of each triangle
-        tri = border_points[border_tri[i]]
-        center, radius = bounding_sphere(tri)
-        triangles.append(tri)
-        tri_center.append(center)
-        max_radius = max(max_radius, radius)
+    # each query only reads the tree, so the points are projected in parallel
+    for i in prange(len(query_points)):
+        nearest_x, nearest_y, nearest_z, nearest_dist_sq = _query(query_points[i], query_radius[i], root, thickness, max_radius, split_axis, split_lo, split_hi, lower_node, upper_node, tri_center, tri_radius, triangle, tri_normal, tri_border_normal)
+        x_proj[i, 0] = nearest_x
+        x_proj[i, 1] = nearest_y
+        x_proj[i, 2] = nearest_z
+        found[i] = nearest_dist_sq < np.inf
 
-    return triangles, tri_center, max_radius
+    return x_proj, found
 
 # each triangle is represented as a point in the tree
+# the tree is a KD-tree stored as flat arrays indexed by node, with the root built last
+# a negative lower node marks a leaf, and encodes the index of the leaf's first triangle as -1 - lower node
+# the upper node of a leaf is the number of triangles in it, and the triangles are sorted so each leaf's are contiguous
 class PerturbProjTree:
-    def __init__(self, x, alpha_std = 0.0, thickness = 0.0):
+    def __init__(self, x, alpha_std = 0.0, thickness = 0.0, leaf_size = 8):
         self.thickness = thickness
+        self.leaf_size = leaf_size
 
         # construct the bounding triangles of the points
         border_points, border_tri = alpha_shape_border(x, alpha_std = alpha_std)
-        triangles, tri_center, self.max_radius = _calc_tri_center(border_points, border_tri)
-        triangles = np.array(triangles)
-        tri_center = np.vstack(tri_center)
-
-        self.center = np.empty((len(triangles) * 2, 3))
-        self.radius_lo = np.empty(len(triangles) * 2)
-        self.radius_hi = np.empty(len(triangles) * 2)
-        self.inside_node = np.empty(len(triangles) * 2, dtype = int)
-        self.outside_node = np.empty(len(triangles) * 2, dtype = int)
-        self.triangle = np.empty((len(triangles) * 2, 3, 3))
-        self.is_leaf = np.empty(len(triangles) * 2, dtype = bool)
+        triangle = border_points[border_tri]
+        # get the minimum bounding sphere of each triangle
+        tri_center, tri_radius = bounding_spheres(triangle)
+        self.max_radius = np.max(tri_radius)
+        # the normals of each triangle are computed once, instead of once per projection
+        tri_normal, tri_border_normal = all_triangle_normals(triangle)
+
+        # the tree is stored as contiguous float32 arrays, which halves the memory read during queries
+        # query points and projections are still computed in float64
+        self.triangle = np.ascontiguousarray(triangle, dtype = np.float32)
+        self.tri_center = np.ascontiguousarray(tri_center, dtype = np.float32)
+        self.tri_radius = np.ascontiguousarray(tri_radius, dtype = np.float32)
+        self.tri_normal = np.ascontiguousarray(tri_normal, dtype = np.float32)
+        self.tri_border_normal = np.ascontiguousarray(tri_border_normal, dtype = np.float32)
+
+        # a binary tree with at least one triangle per leaf has at most 2 * T - 1 nodes
+        num_nodes = len(self.triangle) * 2 - 1
+        self.split_axis = np.empty(num_nodes, dtype = np.int8)
+        self.split_lo = np.empty(num_nodes, dtype = np.float32)
+        self.split_hi = np.empty(num_nodes, dtype = np.float32)
+        self.lower_node = np.empty(num_nodes, dtype = np.int32)
+        self.upper_node = np.empty(num_nodes, dtype = np.int32)
         self.curr_idx = 0
+        self.tri_order = []
+        self.curr_tri = 0
 
-        self.root = self.build(triangles, tri_center)
+        self.root = self.build(np.arange(len(self.triangle)))
 
-    def build(self, curr_triangles, curr_tri_center):
-        if len(curr_triangles) == 0:
+        # sort the triangles in the order of the leaves they are in
+        order = np.concatenate(self.tri_order)
+        self.triangle = self.triangle[order]
+        self.tri_center = self.tri_center[order]
+        self.tri_radius = self.tri_radius[order]
+        self.tri_normal = self.tri_normal[order]
+        self.tri_border_normal = self.tri_border_normal[order]
+
+    def build(self, curr_tri_idx):
+        if len(curr_tri_idx) == 0:
             print("Bad stuff happened when partitioning!!!")
             return None
 
-        if len(curr_triangles) == 1:
-            self.center[self.curr_idx] = curr_tri_center[0]
-            self.triangle[self.curr_idx] = curr_triangles[0]
-            self.is_leaf[self.curr_idx] = True
+        if len(curr_tri_idx) <= self.leaf_size:
+            # a bucket of triangles, starting after the triangles of the leaves that were already built
+            self.lower_node[self.curr_idx] = -1 - self.curr_tri
+            self.upper_node[self.curr_idx] = len(curr_tri_idx)
+            self.tri_order.append(curr_tri_idx)
+            self.curr_tri += len(curr_tri_idx)
             self.curr_idx += 1
             return self.curr_idx - 1
 
-        # pick corner point to partition with
-        partition_center = corner_point(curr_tri_center)
-
-        # get distances from each triangle's point to the partition point
-        distances = np.linalg.norm(curr_tri_center - partition_center[np.newaxis, :], axis = 1)
-
-        # pick the middle point to for the partition radius
-        lo = len(distances) // 2
-        hi = lo - 1
-        # sort by negative distances so all triangle points with the same distance
-        # as the picked mid distance will be to the right in the partition array
-        partition = np.argpartition(-distances, (hi, lo))
-        partition_radius_lo = distances[partition[lo]]
-        partition_radius_hi = distances[partition[hi]]
-
-        inside_idx = partition[lo:]
-        outside_idx = partition[:lo]
-
-        inside_node = self.build(curr_triangles[inside_idx], curr_tri_center[inside_idx])
-        outside_node = self.build(curr_triangles[outside_idx], curr_tri_center[outside_idx])
-
-        self.center[self.curr_idx] = partition_center
-        self.radius_lo[self.curr_idx] = partition_radius_lo
-        self.radius_hi[self.curr_idx] = partition_radius_hi
-        self.inside_node[self.curr_idx] = inside_node
-        self.outside_node[self.curr_idx] = outside_node
-        self.is_leaf[self.curr_idx] = False
+        curr_tri_center = self.tri_center[curr_tri_idx]
+
+        # split along the axis where the triangle points are the most spread out
+        axis = np.argmax(np.ptp(curr_tri_center, axis = 0))
+        coords = curr_tri_center[:, axis]
+
+        # split at the median, so both halves have the same number of triangles
+        mid = len(coords) // 2
+        partition = np.argpartition(coords, (mid - 1, mid))
+        # the largest coordinate in the lower half and the smallest coordinate in the upper half
+        split_lo = coords[partition[mid - 1]]
+        split_hi = coords[partition[mid]]
+
+        lower_idx = partition[:mid]
+        upper_idx = partition[mid:]
+
+        lower_node = self.build(curr_tri_idx[lower_idx])
+        upper_node = self.build(curr_tri_idx[upper_idx])
+
+        self.split_axis[self.curr_idx] = axis
+        self.split_lo[self.curr_idx] = split_lo
+        self.split_hi[self.curr_idx] = split_hi
+        self.lower_node[self.curr_idx] = lower_node
+        self.upper_node[self.curr_idx] = upper_node
         self.curr_idx += 1
 
         return self.curr_idx - 1
 
     def project(self, x_perturb, perturb):
-        res = _project(x_perturb, perturb, self.max_radius, self.thickness, self.root, self.center, self.radius_lo, self.radius_hi, self.inside_node, self.outside_node, self.triangle, self.is_leaf)
-        return np.vstack(res)
+        epsilon = 1e-8
+        distances = np.linalg.norm(perturb, axis = 1)
+        x_proj = np.array(x_perturb, dtype = float)
+
+        # points that are not perturbed are also not projected, so only the
+        # perturbed points are gathered and sent through the tree as one batch
+        moved = np.nonzero(np.abs(distances) >= epsilon)[0]
+
+        # query radius = the perturbation distance
+        # + maximum radius of all triangle circumcircles
+        # + thickness of each triangle
+        query_radius = distances[moved] + self.max_radius + self.thickness
+        nearest_point, found = _project(x_proj[moved], query_radius, self.thickness, self.max_radius, self.root, self.split_axis, self.split_lo, self.split_hi, self.lower_node, self.upper_node, self.tri_center, self.tri_radius, self.triangle, self.tri_normal, self.tri_border_normal)
+
+        # points without any triangles near enough to project onto are moved back
+        not_found = moved[~found]
+        nearest_point[~found] = x_proj[not_found] - perturb[not_found]
+        x_proj[moved] = nearest_point
+
+        return x_proj
+
+# trees are cached by the contents of the point cloud that they are built on, since the alpha shape
+# and the tree are expensive to build, and the same clean point cloud is often projected onto many times
+_tree_cache = OrderedDict()
+_tree_cache_size = 16
+
+def cached_perturb_proj_tree(x, alpha_std = 0.0, thickness = 0.0):
+    key = (x.shape, x.dtype.str, x.tobytes(), alpha_std, thickness)
+
+    if key in _tree_cache:
+        tree = _tree_cache.pop(key)
+    else:
+        tree = PerturbProjTree(x, alpha_std = alpha_std, thickness = thickness)
+
+        if len(_tree_cache) >= _tree_cache_size:
+            _tree_cache.popitem(last = False) # evict the least recently used tree
+
+    _tree_cache[key] = tree
+
+    return tree
@@ -4,7 +4,7 @@ import importlib
 import sys
 
 class PointNet2Interface:
-    def __init__(self, max_points, fft = False, sink = None, chamfer = False):
+    def __init__(self, max_points, fft = False, sink = None, chamfer = False, batch_size = None):
         tf.reset_default_graph()
 
         checkpoint_path = "pointnet2/log/model.ckpt"
@@ -84,12 +84,30 @@ class PointNet2Interface:
             self.train_chamfer = optimizer_chamfer.minimize(-loss + self.alpha_chamfer * (loss_chamfer + self.lambda_chamfer * loss_l2), var_list = [self.x_chamfer])
             self.init_optimizer_chamfer = tf.variables_initializer([optimizer_chamfer.get_slot(self.x_chamfer, name) for name in optimizer_chamfer.get_slot_names()] + list(optimizer_chamfer._get_beta_accumulators()))
 
+        if batch_size is not None:
+            # a copy of the model with a fixed batch size, so many point clouds can be evaluated in one session run
+            # the model reshapes its features using the static batch size, so the batch size cannot be left as None
+            self.batch_size = batch_size
+            self.x_batch_pl, self.y_batch_pl = model.placeholder_inputs(batch_size, max_points)
+
+            with tf.variable_scope(tf.get_variable_scope(), reuse = tf.AUTO_REUSE):
+                logits, end_points = model.get_model(self.x_batch_pl, self.is_training)
+
+            self.y_pred_batch = tf.nn.softmax(logits)
+            # the loss is averaged over the batch, so the loss of each example is computed separately and summed,
+            # which makes the gradients with respect to each example the same as the gradients from grad_fn
+            loss = tf.add_n([model.get_loss(logits[i:i + 1], self.y_batch_pl[i:i + 1], {k: v[i:i + 1] for k, v in end_points.items()}) for i in range(batch_size)])
+            self.grad_loss_wrt_x_batch = tf.gradients(loss, self.x_batch_pl)[0]
+
     def clean_up(self):
         self.sess.close()
 
     def pred_fn(self, x):
         return self.sess.run(self.y_pred, feed_dict = {self.x_pl: [x], self.is_training: False})[0].astype(float)
 
+    def pred_fn_batch(self, xs):
+        return self.run_batches(self.y_pred_batch, xs)
+
     def reset_sink_fn(self, sinks):
         self.sess.run(self.init_optimizer)
         self.sess.run(self.init_sinks, feed_dict = {self.init_sink_pl: [sinks]})
@@ -107,6 +125,9 @@ class PointNet2Interface:
     def grad_fn(self, x, y):
         return self.sess.run(self.grad_loss_wrt_x, feed_dict = {self.x_pl: [x], self.y_pl: [y], self.is_training: False})[0].astype(float)
 
+    def grad_fn_batch(self, xs, ys):
+        return self.run_batches(self.grad_loss_wrt_x_batch, xs, ys)
+
     def train_sink_fn(self, x, y, sink_source, epsilon, lambda_, eta):
         self.sess.run(self.train, feed_dict = {self.x_clean: [x], self.y_pl: [y], self.sink_source: [sink_source], self.epsilon: epsilon, self.lambda_: lambda_, self.eta: eta, self.is_training: False})
 
@@ -114,9 +135,26 @@ class PointNet2Interface:
         self.sess.run(self.train_chamfer, feed_dict = {self.x_clean_chamfer: [x], self.y_pl: [y], self.alpha_chamfer: alpha_chamfer, self.lambda_chamfer: lambda_chamfer, self.eta_chamfer: eta_chamfer, self.is_training: False})
     
     def output_grad_fn(self, x):
+        # all of the output gradients are computed in one session run, instead of one run per output
+        res = self.sess.run(self.grad_out_wrt_x, feed_dict = {self.x_pl: [x], self.is_training: False})
+
+        return np.array(res)[:, 0].astype(float)
+
+    def run_batches(self, tensor, xs, ys = None):
+        # run the batched model over any number of examples, one batch at a time
+        # the last batch is padded with copies of its first example, which does not change the other examples' outputs
         res = []
 
-        for i in range(len(self.grad_out_wrt_x)):
-            res.append(self.sess.run(self.grad_out_wrt_x[i], feed_dict = {self.x_pl: [x], self.is_training: False})[0].astype(float))
+        for i in range(0, len(xs), self.batch_size):
+            x_batch = xs[i:i + self.batch_size]
+            num = len(x_batch)
+            pad = self.batch_size - num
+            feed_dict = {self.x_batch_pl: np.concatenate((x_batch, np.repeat(x_batch[:1], pad, axis = 0))), self.is_training: False}
+
+            if ys is not None:
+                y_batch = ys[i:i + self.batch_size]
+                feed_dict[self.y_batch_pl] = np.concatenate((y_batch, np.repeat(y_batch[:1], pad, axis = 0)))
+
+            res.append(self.sess.run(tensor, feed_dict = feed_dict)[:num])
 
-        return np.array(res)
+        return np.concatenate(res).astype(float)
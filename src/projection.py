@@ -1,5 +1,5 @@
 import numpy as np
-from numba import jit
+from numba import jit, prange
 
 @jit(nopython = True)
 def cross(a, b):
@@ -10,8 +10,8 @@ def norm(a):
     return np.sqrt(np.sum(a ** 2, axis = 1))
 
 @jit(nopython = True)
-def project_point_to_triangle(p_perturb, tri, thickness = 0.0):
-    epsilon = 1e-8
+def triangle_normals(tri):
+    # normals that only depend on the triangle, and not on the projected point
     A = tri[0]
     B = tri[1]
     C = tri[2]
@@ -19,84 +19,216 @@ def project_point_to_triangle(p_perturb, tri, thickness = 0.0):
     n = cross(B - A, C - A) # normal of triangle
     n = n / np.linalg.norm(n)
 
-    proj_perpendicular = n * np.dot(p_perturb - A, n) # vector from triangle to p_perturb
-    proj_perpendicular_norm = np.linalg.norm(proj_perpendicular)
+    # normals of the planes that go through each edge and are perpendicular to the triangle
+    border_planes_n = np.vstack((cross(n, A + n - B), cross(n, A + n - C), cross(n, B + n - C)))
+    border_planes_n = border_planes_n / norm(border_planes_n).reshape((3, 1))
+
+    return n, border_planes_n
+
+@jit(nopython = True)
+def all_triangle_normals(tris):
+    # triangle_normals for many triangles at once, so they can be computed once ahead of time
+    n = np.empty((len(tris), 3))
+    border_planes_n = np.empty((len(tris), 3, 3))
+
+    for i in range(len(tris)):
+        curr_n, curr_border_planes_n = triangle_normals(tris[i])
+        n[i] = curr_n
+        border_planes_n[i] = curr_border_planes_n
+
+    return n, border_planes_n
+
+@jit(nopython = True)
+def project_point_to_triangle(p_perturb, tri, thickness = 0.0):
+    n, border_planes_n = triangle_normals(tri)
+    return np.array(project_point_to_triangle_pre(p_perturb, tri, n, border_planes_n, thickness = thickness))
+
+@jit(nopython = True)
+def _dot_cross(n, u0, u1, u2, v0, v1, v2):
+    # dot product of n with the cross product of u and v
+    return n[0] * (u1 * v2 - u2 * v1) + n[1] * (u2 * v0 - u0 * v2) + n[2] * (u0 * v1 - u1 * v0)
+
+@jit(nopython = True)
+def _closest_on_edge(qx, qy, qz, P, Q, normal):
+    # project q onto the plane that goes through the edge P to Q and is perpendicular to the triangle,
+    # and clip it to the closest endpoint if it lands outside of the edge
+    center_x = (P[0] + Q[0]) / 2.0 # center and radius (half of the length) of an edge
+    center_y = (P[1] + Q[1]) / 2.0
+    center_z = (P[2] + Q[2]) / 2.0
+    radius_sq = (center_x - P[0]) ** 2 + (center_y - P[1]) ** 2 + (center_z - P[2]) ** 2
+
+    d = (qx - P[0]) * normal[0] + (qy - P[1]) * normal[1] + (qz - P[2]) * normal[2]
+    sx = qx - normal[0] * d
+    sy = qy - normal[1] * d
+    sz = qz - normal[2] * d
+
+    if (sx - center_x) ** 2 + (sy - center_y) ** 2 + (sz - center_z) ** 2 > radius_sq:
+        # get closest vertex of triangle
+        P_dist_sq = (P[0] - sx) ** 2 + (P[1] - sy) ** 2 + (P[2] - sz) ** 2
+        Q_dist_sq = (Q[0] - sx) ** 2 + (Q[1] - sy) ** 2 + (Q[2] - sz) ** 2
+
+        if Q_dist_sq < P_dist_sq:
+            return Q[0], Q[1], Q[2]
+        else:
+            return P[0], P[1], P[2]
+
+    return sx, sy, sz
 
+@jit(nopython = True)
+def project_point_to_triangle_pre(p_perturb, tri, n, border_planes_n, thickness = 0.0):
+    # project_point_to_triangle with the triangle's normals precomputed by triangle_normals
+    # this is written with scalars so the point stays in registers and no temporary arrays are allocated,
+    # and the projected point is returned as a tuple of coordinates
+    epsilon = 1e-8
+    A = tri[0]
+    B = tri[1]
+    C = tri[2]
+    px = p_perturb[0]
+    py = p_perturb[1]
+    pz = p_perturb[2]
+
+    # vector from triangle to p_perturb
+    d = (px - A[0]) * n[0] + (py - A[1]) * n[1] + (pz - A[2]) * n[2]
+    perp_x = n[0] * d
+    perp_y = n[1] * d
+    perp_z = n[2] * d
+    proj_perpendicular_norm = np.sqrt(perp_x * perp_x + perp_y * perp_y + perp_z * perp_z)
+
+    # projection onto triangle, ignoring thickness
+    tri_x = px - perp_x
+    tri_y = py - perp_y
+    tri_z = pz - perp_z
+
+    # length of the vector describing triangle thickness, and its scale relative to the vector from the triangle
     if np.abs(proj_perpendicular_norm) < epsilon:
-        tri_width = np.zeros(3) # perturbation is on the triangle
+        tri_width = 0.0 # perturbation is on the triangle
+        tri_width_scale = 0.0
     else:
-        tri_width = thickness * proj_perpendicular / proj_perpendicular_norm # vector describing triangle thickness
-
-    if proj_perpendicular_norm > np.linalg.norm(tri_width):
-        p_proj = p_perturb - proj_perpendicular + tri_width # project and offset due to the thickness
+        tri_width = np.abs(thickness)
+        tri_width_scale = thickness / proj_perpendicular_norm
+
+    if proj_perpendicular_norm > tri_width:
+        # project and offset due to the thickness
+        res_x = tri_x + tri_width_scale * perp_x
+        res_y = tri_y + tri_width_scale * perp_y
+        res_z = tri_z + tri_width_scale * perp_z
     else:
-        p_proj = p_perturb # keep perturbation since it is in the thick triangle
-
-    p_proj_tri = p_perturb - proj_perpendicular # projection onto triangle, ignoring thickness
-    A_n = cross(B - A, p_proj_tri - A)
-    B_n = cross(C - B, p_proj_tri - B)
-    C_n = cross(A - C, p_proj_tri - C)
-
-    if np.dot(n, A_n) < 0.0 or np.dot(n, B_n) < 0.0 or np.dot(n, C_n) < 0.0: # projection not in triangle
-        border_planes = ((A, B, A + n), (A, C, A + n), (B, C, B + n))
-        border_planes_n = np.vstack((cross(n, A + n - B), cross(n, A + n - C), cross(n, B + n - C)))
-        border_planes_n = border_planes_n / norm(border_planes_n).reshape((3, 1))
-
-        border_points = np.empty((3, 3))
-
-        for i in range(3):
-            plane = border_planes[i]
-            normal = border_planes_n[i]
-            center = (plane[0] + plane[1]) / 2.0 # center and radius (half of the length) of an edge
-            radius = np.linalg.norm(center - plane[0])
-            p_plane = p_proj_tri - normal * np.dot(p_proj_tri - plane[0], normal) # project p_proj_tri onto plane
-
-            if np.linalg.norm(p_plane - center) > radius:
-                points = np.vstack((plane[0], plane[1]))
-                idx = np.argmin(norm(points - p_plane)) # get closest vertex of triangle
-                border_points[i] = points[idx]
-            else:
-                border_points[i] = p_plane
-
-        # get closest intersection point
-        border_dists = norm(p_proj_tri - border_points)
-        closest_border_point = border_points[np.argmin(border_dists)]
-        closest_to_proj = p_perturb - closest_border_point
-        closest_to_proj_norm = np.linalg.norm(closest_to_proj)
+        # keep perturbation since it is in the thick triangle
+        res_x = px
+        res_y = py
+        res_z = pz
+
+    A_n = _dot_cross(n, B[0] - A[0], B[1] - A[1], B[2] - A[2], tri_x - A[0], tri_y - A[1], tri_z - A[2])
+    B_n = _dot_cross(n, C[0] - B[0], C[1] - B[1], C[2] - B[2], tri_x - B[0], tri_y - B[1], tri_z - B[2])
+    C_n = _dot_cross(n, A[0] - C[0], A[1] - C[1], A[2] - C[2], tri_x - C[0], tri_y - C[1], tri_z - C[2])
+
+    if A_n < 0.0 or B_n < 0.0 or C_n < 0.0: # projection not in triangle
+        # get closest intersection point on the three edges
+        close_x, close_y, close_z = _closest_on_edge(tri_x, tri_y, tri_z, A, B, border_planes_n[0])
+        close_dist_sq = (tri_x - close_x) ** 2 + (tri_y - close_y) ** 2 + (tri_z - close_z) ** 2
+
+        curr_x, curr_y, curr_z = _closest_on_edge(tri_x, tri_y, tri_z, A, C, border_planes_n[1])
+        curr_dist_sq = (tri_x - curr_x) ** 2 + (tri_y - curr_y) ** 2 + (tri_z - curr_z) ** 2
+
+        if curr_dist_sq < close_dist_sq:
+            close_x, close_y, close_z, close_dist_sq = curr_x, curr_y, curr_z, curr_dist_sq
+
+        curr_x, curr_y, curr_z = _closest_on_edge(tri_x, tri_y, tri_z, B, C, border_planes_n[2])
+        curr_dist_sq = (tri_x - curr_x) ** 2 + (tri_y - curr_y) ** 2 + (tri_z - curr_z) ** 2
+
+        if curr_dist_sq < close_dist_sq:
+            close_x, close_y, close_z, close_dist_sq = curr_x, curr_y, curr_z, curr_dist_sq
+
+        to_proj_x = px - close_x
+        to_proj_y = py - close_y
+        to_proj_z = pz - close_z
+        closest_to_proj_norm = np.sqrt(to_proj_x * to_proj_x + to_proj_y * to_proj_y + to_proj_z * to_proj_z)
 
         # clip point to sphere with radius thickness, centered at the closest border point
         if closest_to_proj_norm > thickness and closest_to_proj_norm >= epsilon:
-            p_proj = closest_border_point + thickness * closest_to_proj / closest_to_proj_norm
+            scale = thickness / closest_to_proj_norm
+            res_x = close_x + scale * to_proj_x
+            res_y = close_y + scale * to_proj_y
+            res_z = close_z + scale * to_proj_z
         else:
-            p_proj = p_perturb
+            res_x = px
+            res_y = py
+            res_z = pz
 
-    return p_proj
+    return res_x, res_y, res_z
+
+@jit(nopython = True)
+def _bounding_sphere(A, B, C):
+    # minimum bounding sphere of 3D triangle, written with scalars
+    # returns the coordinates of the center and the radius
+    A_to_B_x = B[0] - A[0]
+    A_to_B_y = B[1] - A[1]
+    A_to_B_z = B[2] - A[2]
+    A_to_C_x = C[0] - A[0]
+    A_to_C_y = C[1] - A[1]
+    A_to_C_z = C[2] - A[2]
+    B_to_C_x = C[0] - B[0]
+    B_to_C_y = C[1] - B[1]
+    B_to_C_z = C[2] - B[2]
+
+    A_to_B_sq = A_to_B_x * A_to_B_x + A_to_B_y * A_to_B_y + A_to_B_z * A_to_B_z
+    A_to_C_sq = A_to_C_x * A_to_C_x + A_to_C_y * A_to_C_y + A_to_C_z * A_to_C_z
+    B_to_C_sq = B_to_C_x * B_to_C_x + B_to_C_y * B_to_C_y + B_to_C_z * B_to_C_z
+
+    # dot products for the angles at A, B, and C
+    dot_A = A_to_B_x * A_to_C_x + A_to_B_y * A_to_C_y + A_to_B_z * A_to_C_z
+    dot_B = -(A_to_B_x * B_to_C_x + A_to_B_y * B_to_C_y + A_to_B_z * B_to_C_z)
+    dot_C = A_to_C_x * B_to_C_x + A_to_C_y * B_to_C_y + A_to_C_z * B_to_C_z
+
+    if dot_A <= 0.0 or dot_B <= 0.0 or dot_C <= 0.0:
+        # right or obtuse triangle, where the longest edge is the diameter
+        if A_to_B_sq >= A_to_C_sq and A_to_B_sq >= B_to_C_sq:
+            P = A
+            Q = B
+            edge_sq = A_to_B_sq
+        elif A_to_C_sq >= B_to_C_sq:
+            P = A
+            Q = C
+            edge_sq = A_to_C_sq
+        else:
+            P = B
+            Q = C
+            edge_sq = B_to_C_sq
+
+        return (P[0] + Q[0]) / 2.0, (P[1] + Q[1]) / 2.0, (P[2] + Q[2]) / 2.0, np.sqrt(edge_sq) / 2.0
+
+    # acute triangle
+    normal_x = A_to_B_y * A_to_C_z - A_to_B_z * A_to_C_y
+    normal_y = A_to_B_z * A_to_C_x - A_to_B_x * A_to_C_z
+    normal_z = A_to_B_x * A_to_C_y - A_to_B_y * A_to_C_x
+    scale = 1.0 / ((normal_x * normal_x + normal_y * normal_y + normal_z * normal_z) * 2.0)
+
+    # get the center of the bounding sphere
+    center_x = A[0] + (A_to_B_sq * (A_to_C_y * normal_z - A_to_C_z * normal_y) + A_to_C_sq * (normal_y * A_to_B_z - normal_z * A_to_B_y)) * scale
+    center_y = A[1] + (A_to_B_sq * (A_to_C_z * normal_x - A_to_C_x * normal_z) + A_to_C_sq * (normal_z * A_to_B_x - normal_x * A_to_B_z)) * scale
+    center_z = A[2] + (A_to_B_sq * (A_to_C_x * normal_y - A_to_C_y * normal_x) + A_to_C_sq * (normal_x * A_to_B_y - normal_y * A_to_B_x)) * scale
+
+    # get the radius of the bounding sphere
+    radius_sq = max((A[0] - center_x) ** 2 + (A[1] - center_y) ** 2 + (A[2] - center_z) ** 2,
+            (B[0] - center_x) ** 2 + (B[1] - center_y) ** 2 + (B[2] - center_z) ** 2,
+            (C[0] - center_x) ** 2 + (C[1] - center_y) ** 2 + (C[2] - center_z) ** 2)
+
+    return center_x, center_y, center_z, np.sqrt(radius_sq)
 
 @jit(nopython = True)
 def bounding_sphere(tri):
     # minimum bounding sphere of 3D triangle
-    A = tri[0]
-    B = tri[1]
-    C = tri[2]
-    A_to_B = B - A
-    A_to_C = C - A
-    B_to_C = C - B
-
-    if np.dot(B - A, C - A) <= 0.0 or np.dot(A - B, C - B) <= 0.0 or np.dot(A - C, B - C) <= 0.0:
-        # right or obtuse triangle
-        edges = np.array((np.linalg.norm(A_to_B), np.linalg.norm(A_to_C), np.linalg.norm(B_to_C)))
-        idx = np.argmax(edges)
-        radius = edges[idx] / 2.0
-        a = np.vstack((A, B, A, C, B, C))
-        b = a[idx * 2:idx * 2 + 1]
-        center = np.sum(b, axis = 0) / 2.0
-    else:
-        # acute triangle
-        normal = cross(A_to_B, A_to_C)
-        # get the center of the bounding sphere
-        center = A + (np.sum(A_to_B ** 2) * cross(A_to_C, normal) + np.sum(A_to_C ** 2) * cross(normal, A_to_B)) / (np.sum(normal ** 2) * 2.0)
-        # get the radius of the bounding sphere
-        radius = np.max(norm(tri - center))
+    center_x, center_y, center_z, radius = _bounding_sphere(tri[0], tri[1], tri[2])
+    return np.array((center_x, center_y, center_z)), radius
+
+@jit(nopython = True, parallel = True)
+def bounding_spheres(tris):
+    # minimum bounding spheres of many 3D triangles at once, tris has shape (T, 3, 3)
+    center = np.empty((len(tris), 3))
+    radius = np.empty(len(tris))
+
+    for i in prange(len(tris)):
+        center[i, 0], center[i, 1], center[i, 2], radius[i] = _bounding_sphere(tris[i, 0], tris[i, 1], tris[i, 2])
 
     return center, radius
 
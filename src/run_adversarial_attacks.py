@@ -55,6 +55,7 @@ defense_args = dict(args.defense_args)
 fft = test_attack == "iter_l2_attack_fft"
 sink = int(attack_args["num_sinks"]) if test_attack == "iter_l2_attack_sinks" else None
 chamfer = test_attack == "chamfer_attack"
+batch_size = 32
 
 class_names_path = "Adversarial-point-perturbations-on-3D-objects/data/shape_names.txt"
 input_data_path = "Adversarial-point-perturbations-on-3D-objects/data/point_clouds.hdf5"
@@ -76,7 +77,7 @@ with h5py.File(input_data_path, "r") as file:
 
 model_name = test_model
 model_type = models[test_model]
-model = model_type(max_points, fft = fft, sink = sink, chamfer = chamfer)
+model = model_type(max_points, fft = fft, sink = sink, chamfer = chamfer, batch_size = batch_size)
 
 attack_name = test_attack
 attack_fn = attacks[test_attack]
@@ -98,11 +99,14 @@ total_attacked = 0
 all_attacked = []
 #avg_dist = 0.0
 
+# the clean point clouds do not depend on the attack, so they are all classified in batches up front
+Y_pred = model.pred_fn_batch(X)
+
 for idx in range(len(X)):
     x = X[idx]
     t = T[idx]
     y_idx = Y[idx] # index of correct output
-    y_pred = model.pred_fn(x)
+    y_pred = Y_pred[idx]
     y_pred_idx = np.argmax(y_pred)
 
     if y_pred_idx == y_idx: # model makes correct prediction
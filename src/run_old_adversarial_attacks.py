@@ -42,6 +42,7 @@ attacks = (
 fft = False
 sink = 30
 chamfer = True
+batch_size = 32
 
 test_attacks = (0, 2, 5, 9, 13, 15, 16)
 
@@ -76,7 +77,9 @@ with h5py.File(input_data_path, "r") as file:
 for model_idx in test_models:
     model_name = models[model_idx][0]
     model_type = models[model_idx][1]
-    model = model_type(max_points, fft = fft, sink = sink, chamfer = chamfer)
+    model = model_type(max_points, fft = fft, sink = sink, chamfer = chamfer, batch_size = batch_size)
+    # the clean point clouds do not depend on the attack or defense, so they are all classified in batches once per model
+    Y_pred = model.pred_fn_batch(X)
 
     for attack_idx in test_attacks:
         attack_name = attacks[attack_idx][0]
@@ -106,7 +109,7 @@ for model_idx in test_models:
                 x = X[idx]
                 t = T[idx]
                 y_idx = Y[idx] # index of correct output
-                y_pred = model.pred_fn(x)
+                y_pred = Y_pred[idx]
                 y_pred_idx = np.argmax(y_pred)
 
                 if y_pred_idx == y_idx: # model makes correct prediction